@@ -1,8 +1,13 @@
 import os
-import json
 import uuid
 import math
-import re
+import string
+import heapq
+import threading
+from collections import OrderedDict
+import ahocorasick
+import numpy as np
+import orjson
 from flask import Flask, render_template, request, redirect, url_for, send_file, jsonify, flash
 from werkzeug.utils import secure_filename
 from datetime import datetime
@@ -12,16 +17,27 @@ UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 ALLOWED_EXT = {"png", "jpg", "jpeg", "gif"}
+# leading magic bytes -> stored extension
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"\xff\xd8\xff": "jpg",
+    b"GIF87a": "gif",
+    b"GIF89a": "gif",
+}
 
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.secret_key = "change_this_for_prod"  # change in production
 
 # Load mapping
-with open(os.path.join(BASE_DIR, "mapping.json"), "r", encoding="utf-8") as f:
-    KB = json.load(f)
+with open(os.path.join(BASE_DIR, "mapping.json"), "rb") as f:
+    KB = orjson.loads(f.read())
 
-SESSIONS = {}  # simple in-memory session store {session_id: result_obj}
+# sessions persist as uploads/sess_{id}.json; SESSIONS is a bounded LRU cache
+# over those files so memory stays flat and any worker can serve /result
+SESSION_CACHE_SIZE = 1024
+SESSIONS = OrderedDict()  # {session_id: result_obj}
+SESSIONS_LOCK = threading.Lock()  # requests run on concurrent threads
 
 
 # configuration: tune these
@@ -31,12 +47,138 @@ WEIGHT_SUPPORTING = 0.8   # per supporting symptom match
 WEIGHT_RED = 2.5          # per red-flag match (high)
 PENALTY_MISSING_REQUIRED = -0.5  # penalty if a required symptom explicitly absent? (optional)
 
+# punctuation -> space; keeps hyphens, apostrophes and underscores (KB ids use them)
+PUNCT_TABLE = str.maketrans({c: " " for c in string.punctuation if c not in "-'_"})
+
 
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXT
 
 
+def sniff_image_ext(stream):
+    """Returns the image extension matching the stream's magic bytes, or None."""
+    head = stream.read(12)
+    stream.seek(0)
+    for sig, ext in IMAGE_SIGNATURES.items():
+        if head.startswith(sig):
+            return ext
+    return None
+
+
+def _session_path(session_id):
+    return os.path.join(app.config["UPLOAD_FOLDER"], f"sess_{session_id}.json")
+
+
+def _cache_session(session_id, result_obj):
+    with SESSIONS_LOCK:
+        SESSIONS[session_id] = result_obj
+        SESSIONS.move_to_end(session_id)
+        while len(SESSIONS) > SESSION_CACHE_SIZE:
+            SESSIONS.popitem(last=False)
+
+
+def save_session(result_obj):
+    session_id = result_obj["session_id"]
+    with open(_session_path(session_id), "wb") as f:
+        f.write(orjson.dumps(result_obj, option=orjson.OPT_INDENT_2))
+    _cache_session(session_id, result_obj)
+
+
+def load_session(session_id):
+    """Returns the stored result for session_id (cache first, then disk), or None."""
+    with SESSIONS_LOCK:
+        result_obj = SESSIONS.get(session_id)
+        if result_obj is not None:
+            SESSIONS.move_to_end(session_id)
+            return result_obj
+    path = _session_path(session_id)
+    if not session_id.isalnum() or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        result_obj = orjson.loads(f.read())
+    _cache_session(session_id, result_obj)
+    return result_obj
+
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+
+def _incidence_matrix(conditions, field, symptom_idx):
+    m = np.zeros((len(conditions), len(symptom_idx)))
+    for c, cond in enumerate(conditions):
+        for s in cond[field]:
+            m[c, symptom_idx[s]] = 1.0
+    return m
+
+
+def _compile_kb(kb):
+    """
+    Precompute the lookup tables derived from a knowledge base.
+    The KB is read-only after load, so this runs once at import for KB.
+    """
+    phrases = frozenset(
+        phrase.lower()
+        for cond in kb.get("conditions", [])
+        for field in ("required_symptoms", "supporting_symptoms", "red_flags")
+        for phrase in cond.get(field, [])
+    )
+
+    # surface phrase -> canonical keywords it yields (a surface can be both a
+    # synonym and a KB phrase, e.g. "red eye")
+    surfaces = {}
+    for s, canonical in kb.get("synonyms", {}).items():
+        surfaces.setdefault(s.lower(), set()).add(canonical.lower())
+    for rf in kb.get("red_flag_keywords", []):
+        surfaces.setdefault(rf.lower(), set()).add(rf.lower())
+    for p in phrases:
+        surfaces.setdefault(p, set()).add(p)
+
+    # one automaton over every phrase: a single pass over the text reports
+    # all (possibly overlapping) occurrences
+    automaton = ahocorasick.Automaton()
+    for surface, canonicals in surfaces.items():
+        if surface:
+            automaton.add_word(surface, (len(surface), tuple(canonicals)))
+    automaton.make_automaton()
+
+    # per-condition symptom sets, lowercased once
+    conditions = [{
+        "name": cond["name"],
+        "required": frozenset(s.lower() for s in cond.get("required_symptoms", [])),
+        "supporting": frozenset(s.lower() for s in cond.get("supporting_symptoms", [])),
+        "red_flags": frozenset(s.lower() for s in cond.get("red_flags", [])),
+        "recommended_tests": cond.get("recommended_tests", []),
+        "urgency": cond.get("urgency", "see_gp"),
+    } for cond in kb.get("conditions", [])]
+
+    # condition x symptom incidence matrices, so scoring is one product per field
+    symptom_idx = {s: i for i, s in enumerate(sorted(phrases))}
+
+    return {
+        "automaton": automaton,
+        "conditions": conditions,
+        "symptom_idx": symptom_idx,
+        "required_matrix": _incidence_matrix(conditions, "required", symptom_idx),
+        "supporting_matrix": _incidence_matrix(conditions, "supporting", symptom_idx),
+        "red_matrix": _incidence_matrix(conditions, "red_flags", symptom_idx),
+    }
+
+
+KB_INDEX = _compile_kb(KB)
+
+# quick-pick checkboxes on the index page
+COMMON_SYMPTOMS = sorted({
+    s for cond in KB["conditions"]
+    for s in cond.get("required_symptoms", []) + cond.get("supporting_symptoms", [])
+})
+
+
+def _kb_index(kb):
+    return KB_INDEX if kb is KB else _compile_kb(kb)
+
+
 def extract_keywords(text, checked_list=None, kb=KB):
     """
     Returns a set of normalized keywords found in text + checked_list.
@@ -44,14 +186,6 @@ def extract_keywords(text, checked_list=None, kb=KB):
     - checked_list: list from form checkboxes (strings)
     - kb: knowledge base loaded from mapping.json (contains synonyms and conditions)
     """
-    if not text:
-        text = ""
-    text_norm = text.lower()
-    # remove extra punctuation but keep internal hyphens
-    text_norm = re.sub(r"[^\w\s\-']", " ", text_norm)
-    # collapse multi spaces
-    text_norm = re.sub(r"\s+", " ", text_norm).strip()
-
     found = set()
 
     # 1) add checked items (they are already explicit)
@@ -60,42 +194,23 @@ def extract_keywords(text, checked_list=None, kb=KB):
             if it:
                 found.add(it.lower().strip())
 
-    # 2) check synonyms: if synonym phrase present in text -> add canonical
-    syn_map = kb.get("synonyms", {})
-    # sort synonyms by length (longer first) to avoid partial matches
-    for s in sorted(syn_map.keys(), key=lambda x: -len(x)):
-        patt = r"\b" + re.escape(s.lower()) + r"\b"
-        if re.search(patt, text_norm):
-            found.add(syn_map[s].lower())
+    # checkboxes only: nothing to normalize or scan
+    if not text or text.isspace():
+        return found
 
-    # 3) check explicit red-flag keywords (exact phrase)
-    for rf in kb.get("red_flag_keywords", []):
-        patt = r"\b" + re.escape(rf.lower()) + r"\b"
-        if re.search(patt, text_norm):
-            found.add(rf.lower())
-
-    # 4) check conditions' required/supporting/red words (multi-word phrases)
-    # build a set of candidate phrases from KB
-    phrases = set()
-    for cond in kb.get("conditions", []):
-        for field in ("required_symptoms", "supporting_symptoms", "red_flags"):
-            for phrase in cond.get(field, []):
-                phrases.add(phrase.lower())
-
-    # match longer phrases first
-    for phrase in sorted(phrases, key=lambda x: -len(x)):
-        patt = r"\b" + re.escape(phrase) + r"\b"
-        if re.search(patt, text_norm):
-            found.add(phrase)
-
-    # 5) also add single tokens from text if they match any KB token (fallback)
-    tokens = text_norm.split()
-    kb_tokens = set()
-    for p in phrases:
-        kb_tokens.update(p.split())
-    for t in tokens:
-        if t in kb_tokens:
-            found.add(t)
+    # remove extra punctuation but keep internal hyphens, then collapse spaces
+    text_norm = " ".join(text.lower().translate(PUNCT_TABLE).split())
+    index = _kb_index(kb)
+
+    # 2) synonyms, red-flag keywords and condition phrases in one scan;
+    # keep only whole-word occurrences
+    for end, (length, canonicals) in index["automaton"].iter(text_norm):
+        start = end - length + 1
+        if start > 0 and _is_word_char(text_norm[start - 1]):
+            continue
+        if end + 1 < len(text_norm) and _is_word_char(text_norm[end + 1]):
+            continue
+        found.update(canonicals)
 
     return set(found)
 
@@ -104,58 +219,32 @@ def run_rule_engine(parsed_symptoms, duration_text=None, severity=None, kb=KB):
     Returns:
       - ranked list of conditions with normalized 'score' between 0 and 1
       - final_urgency ('self_care', 'see_gp', 'urgent')
-      - explanation details (list of dicts with matched items)
     """
     parsed_set = set([s.lower() for s in parsed_symptoms])
-    raw_scores = []
-    explanations = []
-
-    # compute raw scores
-    for cond in kb["conditions"]:
-        cond_name = cond["name"]
-        score = WEIGHT_BASE
-        matches = {"required": [], "supporting": [], "red_flags": []}
-
-        # required
-        for req in cond.get("required_symptoms", []):
-            r = req.lower()
-            if r in parsed_set:
-                score += WEIGHT_REQUIRED
-                matches["required"].append(r)
-
-        # supporting
-        for sup in cond.get("supporting_symptoms", []):
-            s = sup.lower()
-            if s in parsed_set:
-                score += WEIGHT_SUPPORTING
-                matches["supporting"].append(s)
-
-        # red flags
-        for rf in cond.get("red_flags", []):
-            rfw = rf.lower()
-            if rfw in parsed_set:
-                score += WEIGHT_RED
-                matches["red_flags"].append(rfw)
-
-        raw_scores.append({"condition": cond_name, "raw_score": score,
-                           "matches": matches,
-                           "recommended_tests": cond.get("recommended_tests", []),
-                           "declared_urgency": cond.get("urgency", "see_gp")})
-
-    # normalize raw_score to 0..1
-    scores_vals = [r["raw_score"] for r in raw_scores]
-    max_raw = max(scores_vals) if scores_vals else 1.0
-    min_raw = min(scores_vals) if scores_vals else 0.0
 
+    # compute raw scores (match details are only built for the returned top-3)
+    index = _kb_index(kb)
+    conditions = index["conditions"]
+    symptom_idx = index["symptom_idx"]
+    v = np.zeros(len(symptom_idx))
+    v[[symptom_idx[s] for s in parsed_set if s in symptom_idx]] = 1.0
+    red_hits = index["red_matrix"] @ v
+    raw = (WEIGHT_BASE
+           + WEIGHT_REQUIRED * (index["required_matrix"] @ v)
+           + WEIGHT_SUPPORTING * (index["supporting_matrix"] @ v)
+           + WEIGHT_RED * red_hits)
+    # weights * counts sum in a different order than per-match +=; drop the float noise
+    raw = np.round(raw, 9)
+
+    # normalize raw scores to 0..1
+    min_raw, max_raw = (raw.min(), raw.max()) if raw.size else (0.0, 1.0)
     # avoid divide by zero
     span = max_raw - min_raw if max_raw != min_raw else 1.0
-    for r in raw_scores:
-        r["score"] = (r["raw_score"] - min_raw) / span
-        # round for display
-        r["score"] = round(r["score"], 3)
+    # round for display (python round: correctly rounded, unlike np.round)
+    scores = [round(x, 3) for x in ((raw - min_raw) / span).tolist()]
 
-    # sort descending
-    ranked = sorted(raw_scores, key=lambda x: x["score"], reverse=True)
+    # top-3 by score (indices into conditions / scores); ties keep KB order
+    top_idx = heapq.nlargest(3, range(len(scores)), key=scores.__getitem__)
 
     # Decide final urgency:
     # - If any matched red_flag anywhere -> urgent
@@ -163,42 +252,40 @@ def run_rule_engine(parsed_symptoms, duration_text=None, severity=None, kb=KB):
     # - Else self-care
     final_urgency = "self_care"
     # check red flags globally
-    global_red = False
-    for r in ranked:
-        if r["matches"]["red_flags"]:
-            global_red = True
-            break
+    global_red = bool(red_hits.any())
     if global_red:
         final_urgency = "urgent"
     else:
-        top = ranked[0]
-        if top["declared_urgency"] == "urgent" and top["score"] >= 0.35:
+        top = conditions[top_idx[0]]
+        top_score = scores[top_idx[0]]
+        if top["urgency"] == "urgent" and top_score >= 0.35:
             final_urgency = "urgent"
-        elif top["declared_urgency"] == "see_gp" and top["score"] >= 0.25:
+        elif top["urgency"] == "see_gp" and top_score >= 0.25:
             final_urgency = "see_gp"
         else:
             final_urgency = "self_care"
 
     # prepare top-3
     top3 = []
-    for r in ranked[:3]:
+    for i in top_idx:
+        cond = conditions[i]
         top3.append({
-            "condition": r["condition"],
-            "score": r["score"],
-            "matches": r["matches"],
-            "recommended_tests": r["recommended_tests"],
-            "declared_urgency": r["declared_urgency"]
+            "condition": cond["name"],
+            "score": scores[i],
+            "matches": {
+                "required": sorted(cond["required"] & parsed_set),
+                "supporting": sorted(cond["supporting"] & parsed_set),
+                "red_flags": sorted(cond["red_flags"] & parsed_set),
+            },
+            "recommended_tests": cond["recommended_tests"],
+            "declared_urgency": cond["urgency"]
         })
 
-    return top3, final_urgency, {"ranked_all": ranked}
+    return top3, final_urgency
 
 @app.route("/", methods=["GET"])
 def index():
-    common_symptoms = sorted({
-        s for cond in KB["conditions"]
-        for s in cond.get("required_symptoms", []) + cond.get("supporting_symptoms", [])
-    })
-    return render_template("index.html", common_symptoms=common_symptoms)
+    return render_template("index.html", common_symptoms=COMMON_SYMPTOMS)
 
 
 @app.route("/submit", methods=["POST"])
@@ -214,19 +301,22 @@ def submit():
     # handle file
     uploaded_fn = None
     file = request.files.get("image")
-    if file and file.filename != "" and allowed_file(file.filename):
-        filename = secure_filename(f"{uuid.uuid4().hex}_{file.filename}")
-        file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-        uploaded_fn = filename
-    elif file and file.filename != "":
-        flash("Uploaded file type not allowed. Allowed: png/jpg/jpeg/gif")
+    if file and file.filename != "":
+        # check the name and the actual content before anything is written
+        ext = sniff_image_ext(file.stream) if allowed_file(file.filename) else None
+        if ext:
+            uploaded_fn = f"{uuid.uuid4().hex}.{ext}"
+            file.save(os.path.join(app.config["UPLOAD_FOLDER"], uploaded_fn))
+            app.logger.info("saved upload %s as %s", secure_filename(file.filename), uploaded_fn)
+        else:
+            flash("Uploaded file type not allowed. Allowed: png/jpg/jpeg/gif")
 
     # parse text into keywords
     parsed_from_text = extract_keywords(text, checked_list=checked, kb=KB)
     # combine with checkboxes
     combined = parsed_from_text
     # run rule engine
-    top_conditions, urgency, debug = run_rule_engine(list(combined), duration, severity, kb=KB)
+    top_conditions, urgency = run_rule_engine(list(combined), duration, severity, kb=KB)
 
     session_id = uuid.uuid4().hex
     result_obj = {
@@ -247,8 +337,8 @@ def submit():
         #"red_flags": red_flags
     }
 
-    # store session (in-memory); for real app persist to DB
-    SESSIONS[session_id] = result_obj
+    # store session (json file + in-memory cache); for real app persist to DB
+    save_session(result_obj)
 
     return redirect(url_for("result", session_id=session_id))
 
@@ -256,7 +346,7 @@ def submit():
 
 @app.route("/result/<session_id>", methods=["GET"])
 def result(session_id):
-    res = SESSIONS.get(session_id)
+    res = load_session(session_id)
     if not res:
         return "Session not found", 404
     return render_template("result.html", r=res)
@@ -264,16 +354,17 @@ def result(session_id):
 
 @app.route("/export/<session_id>", methods=["GET"])
 def export(session_id):
-    res = SESSIONS.get(session_id)
-    if not res:
+    path = _session_path(session_id)
+    if not session_id.isalnum() or not os.path.exists(path):
         return "Session not found", 404
-    # Create a small json file to send
+    # the session file written at submit time is the report
     fname = f"report_{session_id}.json"
-    path = os.path.join(app.config["UPLOAD_FOLDER"], fname)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(res, f, indent=2)
-    return send_file(path, as_attachment=True, download_name=fname)
+    return send_file(path, mimetype="application/json", as_attachment=True, download_name=fname)
 
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0" , port=8000)
+    # production WSGI server (no debugger/reloader); on Linux you can instead
+    # run `gunicorn -w 4 --preload -b 0.0.0.0:8000 app:app` to share the
+    # load-time KB tables across forked workers
+    from waitress import serve
+    serve(app, host="0.0.0.0", port=8000)